@@ -1,18 +1,29 @@
 #!/usr/bin/env -S uv run
 # dependencies = [
 #     "click>=8.1.8",
-#     "prompt-toolkit>=3.0.50",
-#     "rich>=13.9.4",
 # ]
 
+import collections
+import os
 import subprocess
-import re
+import sys
+import tempfile
+import time
+from pathlib import Path
+
 import click
-import random
+
+CACHE_TTL = 30
+
+COLUMNS = ("IP", "HOSTNAME", "COUNTRY", "CITY")
+
+Node = collections.namedtuple("Node", "ip hostname country city")
+
+NO_EXIT_NODE = Node(ip="", hostname="", country="", city="")
 
 
 @click.command()
-@click.argument("pattern")
+@click.argument("pattern", required=False)
 @click.option(
     "--hostname", "-h", is_flag=True, help="Match against hostname instead of country"
 )
@@ -22,12 +33,29 @@ import random
 @click.option(
     "--dry-run", "-n", is_flag=True, help="Show selected node without activating it"
 )
-def main(pattern, hostname, city, dry_run):
+@click.option(
+    "--refresh",
+    "--no-cache",
+    "-r",
+    is_flag=True,
+    help="Ignore the cached exit node list and query tailscale",
+)
+@click.option(
+    "--batch",
+    "-b",
+    is_flag=True,
+    help="Read patterns from stdin, one per line, and print the matching nodes",
+)
+def main(pattern, hostname, city, dry_run, refresh, batch):
     """
     A script to select a Tailscale exit node by matching pattern.
 
     PATTERN: Text to match (e.g. Sweden, London, us-nyc)
     """
+    if batch and pattern is not None:
+        raise click.UsageError("PATTERN cannot be used with --batch.")
+    if not batch and pattern is None:
+        raise click.UsageError("Missing argument 'PATTERN'.")
 
     if hostname:
         field = "hostname"
@@ -36,103 +64,238 @@ def main(pattern, hostname, city, dry_run):
     else:
         field = "country"
 
-    selected_node = get_node(field, pattern)
-    node_ip = selected_node["ip"]
+    if batch:
+        resolve_batch(field, sys.stdin, use_cache=not refresh)
+        return
+
+    selected_node = get_node(field, pattern, use_cache=not refresh)
+    if selected_node is None:
+        sys.exit(1)
+    node_ip = selected_node.ip
 
     if dry_run:
         click.echo(
-            f"Would set exit node to: {node_ip} ({selected_node['hostname']}, {selected_node['city']}, {selected_node['country']})"
+            f"Would set exit node to: {node_ip} ({selected_node.hostname}, {selected_node.city}, {selected_node.country})"
         )
         return
 
     set_exit_node(node_ip)
 
 
-def get_node(field, pattern):
+def resolve_batch(field, patterns, use_cache=True):
+    """
+    Prints the node matching each pattern, fetching the exit node list once.
+    """
+    exit_nodes = get_exit_nodes(field, use_cache)
+    failed = False
+    for line in patterns:
+        pattern = line.strip()
+        if not pattern:
+            continue
+        node = resolve_node(field, pattern, exit_nodes)
+        if node is None:
+            failed = True
+            continue
+        click.echo(
+            f"{pattern}\t{node.ip}\t{node.hostname}\t{node.city}\t{node.country}"
+        )
+    if failed:
+        sys.exit(1)
+
+
+def get_node(field, pattern, use_cache=True):
+    if pattern == "none":
+        return NO_EXIT_NODE
+    return resolve_node(field, pattern, get_exit_nodes(field, use_cache))
+
+
+def resolve_node(field, pattern, exit_nodes):
+    """
+    Selects a node whose field matches the pattern from the result of
+    get_exit_nodes.
+    """
     if pattern == "none":
-        return {
-            "ip": "",
-            "hostname": "",
-            "city": "",
-            "country": "",
-        }
-    output = get_exit_node_list()
-    nodes = parse_exit_nodes(output)
-
-    values = get_unique_values(nodes, field)
-
-    if not values:
+        return NO_EXIT_NODE
+    buckets, lower_values = exit_nodes
+
+    if not buckets:
         click.echo("No exit nodes found.", err=True)
         return
 
-    matching_values = [v for v in values if pattern.lower() in v.lower()]
+    lower_pattern = pattern.lower()
+    if lower_pattern in lower_values:
+        matching_values = [lower_values[lower_pattern]]
+    else:
+        matching_values = [
+            v for lower_v, v in lower_values.items() if lower_pattern in lower_v
+        ]
 
     if not matching_values:
         click.echo(
-            f"Error: No {field} matching '{pattern}' found. Available {field}s: {', '.join(values)}",
+            f"Error: No {field} matching '{pattern}' found. Available {field}s: {', '.join(sorted(buckets))}",
             err=True,
         )
         return
 
     if len(matching_values) > 1:
         click.echo(
-            f"Error: Ambiguous match '{pattern}' matches multiple {field}s: {', '.join(matching_values)}",
+            f"Error: Ambiguous match '{pattern}' matches multiple {field}s: {', '.join(sorted(matching_values))}",
             err=True,
         )
         return
 
     matched_value = matching_values[0]
-    filtered_nodes = [node for node in nodes if node[field] == matched_value]
+    filtered_nodes = buckets[matched_value]
+
+    import random
+
     selected_node = random.choice(filtered_nodes)
-    node_ip = selected_node["ip"]
+    node_ip = selected_node.ip
 
-    if not re.match(r"^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$", node_ip):
+    if not (node_ip.count(".") == 3 and node_ip.replace(".", "").isdigit()):
         click.echo("Invalid IP address format.", err=True)
         return
 
     return selected_node
 
 
-def get_exit_node_list():
+def get_exit_nodes(field, use_cache=True):
+    """
+    Retrieves the Tailscale exit nodes, grouped by the given field.
+
+    The output of 'tailscale exit-node list' is cached on disk for CACHE_TTL
+    seconds to avoid running the tailscale CLI on every invocation.
     """
-    Retrieves the list of Tailscale exit nodes.
+    if use_cache:
+        output = read_cached_exit_node_list()
+        if output is not None:
+            return parse_and_bucket(output, field)
+    return parse_exit_nodes_streaming(field)
+
+
+def read_cached_exit_node_list():
     """
-    result = subprocess.run(
-        ["tailscale", "exit-node", "list"],
-        capture_output=True,
-        text=True,
-        check=True,
-    )
-    return result.stdout
+    Returns the cached exit node list, or None if it is missing, empty or
+    stale.
+    """
+    path = get_cache_path()
+    try:
+        if path.stat().st_mtime > time.time() - CACHE_TTL:
+            return path.read_text() or None
+    except OSError:
+        pass
+    return None
+
+
+def parse_exit_nodes_streaming(field):
+    """
+    Runs 'tailscale exit-node list', parsing each line as it is read, and
+    caches the output.
+    """
+    lines = []
+
+    def record(stream):
+        for line in stream:
+            lines.append(line)
+            yield line
+
+    error = None
+    with subprocess.Popen(
+        ["tailscale", "exit-node", "list"], stdout=subprocess.PIPE, text=True
+    ) as process:
+        try:
+            result = parse_lines(record(process.stdout), field)
+        except click.ClickException as e:
+            # Drain the output so a parse error can't mask a failed command
+            error = e
+            process.stdout.read()
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, process.args)
+    if error is not None:
+        raise error
+
+    write_cached_exit_node_list("".join(lines))
+    return result
 
 
-def parse_exit_nodes(output):
+def write_cached_exit_node_list(output):
     """
-    Parses the output of 'tailscale exit-node list'.
+    Atomically replaces the cached exit node list, so that concurrent runs
+    never read a partially written file.
     """
-    nodes = []
-    for line in output.strip().split("\n"):
-        if line.startswith("#"):
+    path = get_cache_path()
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(output)
+            os.replace(tmp_path, path)
+        except OSError:
+            os.unlink(tmp_path)
+            raise
+    except OSError:
+        pass
+
+
+def get_cache_path():
+    """
+    Returns the path of the exit node list cache file.
+    """
+    cache_home = os.environ.get("XDG_CACHE_HOME") or "~/.cache"
+    return Path(cache_home).expanduser() / "tailscale-exits.txt"
+
+
+def parse_and_bucket(output, field):
+    """
+    Parses the output of 'tailscale exit-node list', grouping the nodes
+    by the value of the given field.
+    """
+    return parse_lines(output.splitlines(), field)
+
+
+def parse_lines(lines, field):
+    """
+    Parses lines of 'tailscale exit-node list' output, grouping the nodes
+    by the value of the given field.
+
+    Returns the buckets and a map from each lowercased value to the value.
+    """
+    buckets = {}
+    lower_values = {}
+    columns = None
+    for line in lines:
+        if not line.strip() or line.startswith("#"):
+            continue
+        if columns is None:
+            columns = get_column_slices(line)
             continue
-        # Split on 2 or more spaces
-        parts = re.split(r"\s{2,}", line.strip())
-        if len(parts) >= 4:
-            nodes.append(
-                {
-                    "ip": parts[0],
-                    "hostname": parts[1],
-                    "country": parts[2],
-                    "city": parts[3],
-                }
-            )
-    return nodes
+        cells = [line[column].strip() for column in columns]
+        # Skip rows with blank cells, such as nodes without a location
+        if all(cells):
+            node = Node(*cells)
+            value = getattr(node, field)
+            bucket = buckets.get(value)
+            if bucket is None:
+                bucket = buckets[value] = []
+                lower_values[value.lower()] = value
+            bucket.append(node)
+    return buckets, lower_values
 
 
-def get_unique_values(nodes, field):
+def get_column_slices(header):
     """
-    Extracts a list of unique values for the given field.
+    Returns slices for the IP, hostname, country and city columns, based on
+    the offsets of their titles in the header line.
     """
-    return sorted(list({node[field] for node in nodes}))
+    try:
+        offsets = [header.index(title) for title in COLUMNS]
+    except ValueError:
+        raise click.ClickException(f"Unexpected exit node list header: {header}")
+    offsets[0] = 0
+    status = header.find("STATUS")
+    ends = offsets[1:] + [status if status != -1 else None]
+    return [slice(start, end) for start, end in zip(offsets, ends)]
 
 
 def set_exit_node(ip_address):